@@ -1,85 +1,639 @@
 import streamlit as st
 from streamlit_geolocation import streamlit_geolocation
 import folium
-from folium.plugins import LocateControl
+from folium.plugins import LocateControl, FastMarkerCluster
 from streamlit_folium import st_folium
 import json
+import orjson
 import os
 from datetime import datetime
 import base64
-from PIL import Image
+from PIL import Image, ImageOps
 import io
 import hashlib
-from geopy.distance import great_circle
+import hmac
+import bcrypt
+import numpy as np
 import time
 import googlemaps
 import openai
 import re
+import math
+import html
+import sqlite3
+import threading
+import queue
+import shutil
+import atexit
+import logging
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
 
 # --- 設定と初期化 ---
 DATA_DIR = "data"
 USERS_FILE = os.path.join(DATA_DIR, "users.json")
-NOTES_FILE = os.path.join(DATA_DIR, "notes.json")
+USERS_DB = os.path.join(DATA_DIR, "users.db")
+NOTES_FILE = os.path.join(DATA_DIR, "notes.jsonl")
+LEGACY_NOTES_FILE = os.path.join(DATA_DIR, "notes.json")
+ENTRIES_DIR = os.path.join(DATA_DIR, "entries")
+IMAGES_DIR = os.path.join(DATA_DIR, "images")
+COMPACT_THRESHOLD = 100
+MAX_IMAGE_SIZE = (1280, 1280)
+EMBEDDING_MODEL = "text-embedding-3-small"
+RECOMMEND_MODEL = "gpt-4o-mini"
+RECOMMEND_CANDIDATES = 20
+LOCATION_MIN_MOVE_M = 25
+LOCATION_MAX_AGE_S = 30
+ENTRY_PAGE_SIZE = 20
+AUTO_REFRESH_INTERVAL_S = 5
+WRITER_THREAD_NAME = "ikitsuke-notes-writer"
+
+# AIの応答は会話文とおすすめノートIDを持つJSONに固定する（未決定の場合IDは空文字）
+RECOMMEND_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "note_recommendation",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "reply": {"type": "string"},
+                "recommended_note_id": {"type": "string"}
+            },
+            "required": ["reply", "recommended_note_id"],
+            "additionalProperties": False
+        }
+    }
+}
+_REPLY_START_RE = re.compile(r'"reply"\s*:\s*"')
+_HIGH_SURROGATE_RE = re.compile(r"\\u[dD][89abAB]")
+# 空白区切りの各トークンから先頭の # を除いた部分
+_HASHTAG_RE = re.compile(r"#*([^\s#]\S*)")
+_LEGACY_HASH_RE = re.compile(r"[0-9a-f]{64}")
+
+# FastMarkerClusterの各行 [lat, lng, popup_html] からマーカーを作るJS
+NOTE_MARKER_CALLBACK = """
+function (row) {
+    var icon = L.AwesomeMarkers.icon({icon: 'book', prefix: 'fa', markerColor: 'beige'});
+    var marker = L.marker(new L.LatLng(row[0], row[1]), {icon: icon});
+    marker.bindPopup(row[2]);
+    return marker;
+}
+"""
 
 os.makedirs(DATA_DIR, exist_ok=True)
+os.makedirs(ENTRIES_DIR, exist_ok=True)
+os.makedirs(IMAGES_DIR, exist_ok=True)
 
 # --- データ管理 & ヘルパー関数 ---
 def load_data(file_path, is_dict=False):
+    # 旧形式の JSON ファイルを取り込むときだけ使う一度きりの読み込みのため、キャッシュはしない
     if os.path.exists(file_path):
-        with open(file_path, "r", encoding="utf-8") as f:
+        with open(file_path, "rb") as f:
             content = f.read()
             if content:
-                return json.loads(content)
+                return orjson.loads(content)
     return {} if is_dict else []
 
-def save_data(file_path, data):
-    with open(file_path, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=4, ensure_ascii=False)
+# --- ユーザー管理 (SQLite) ---
+@st.cache_resource(show_spinner=False)
+def init_users_db():
+    with closing(sqlite3.connect(USERS_DB)) as conn, conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS users (id TEXT PRIMARY KEY, name TEXT NOT NULL, password_hash TEXT NOT NULL)")
+        # 旧形式の users.json があれば初回のみ取り込む
+        if os.path.exists(USERS_FILE) and not conn.execute("SELECT 1 FROM users LIMIT 1").fetchone():
+            legacy_users = load_data(USERS_FILE, is_dict=True)
+            conn.executemany("INSERT OR IGNORE INTO users (id, name, password_hash) VALUES (?, ?, ?)",
+                             [(u["id"], u["name"], u["password_hash"]) for u in legacy_users.values()])
+
+def get_user(user_id):
+    with closing(sqlite3.connect(USERS_DB)) as conn:
+        row = conn.execute("SELECT id, name, password_hash FROM users WHERE id = ?", (user_id,)).fetchone()
+    if row is None:
+        return None
+    return {"id": row[0], "name": row[1], "password_hash": row[2]}
 
-def hash_password(password):
-    return hashlib.sha256(password.encode()).hexdigest()
+def update_password_hash(user_id, password_hash):
+    with closing(sqlite3.connect(USERS_DB)) as conn, conn:
+        conn.execute("UPDATE users SET password_hash = ? WHERE id = ?", (password_hash, user_id))
 
-def image_to_base64(image, format="PNG"):
-    buffered = io.BytesIO()
-    if image.mode in ("RGBA", "P"):
+def create_user(user):
+    # IDが既に使われている場合はFalseを返す
+    try:
+        with closing(sqlite3.connect(USERS_DB)) as conn, conn:
+            conn.execute("INSERT INTO users (id, name, password_hash) VALUES (?, ?, ?)",
+                         (user["id"], user["name"], user["password_hash"]))
+        return True
+    except sqlite3.IntegrityError:
+        return False
+
+# --- 画像の保存 ---
+# 画像は内容のハッシュをファイル名として data/images/ に保存し、ノートには DATA_DIR からの相対パスのみを持たせる
+def save_image(image):
+    # EXIFの回転情報を画素に反映してからメタデータを捨て、表示に十分なサイズまで縮小する。
+    # パレット画像などはPillowが最近傍補間でしか縮小しないため、先にRGBへ変換してから縮小する
+    ImageOps.exif_transpose(image, in_place=True)
+    image.info.clear()
+    if image.mode not in ("RGB", "L"):
         image = image.convert("RGB")
-    image.save(buffered, format=format)
-    return "data:image/png;base64," + base64.b64encode(buffered.getvalue()).decode()
+    if image.width > MAX_IMAGE_SIZE[0] or image.height > MAX_IMAGE_SIZE[1]:
+        image.thumbnail(MAX_IMAGE_SIZE, Image.Resampling.LANCZOS)
+    buffered = io.BytesIO()
+    image.save(buffered, format="JPEG", quality=85, optimize=True, progressive=True)
+    data = buffered.getvalue()
+    rel_path = f"images/{hashlib.sha256(data).hexdigest()}.jpg"
+    abs_path = os.path.join(DATA_DIR, rel_path)
+    if not os.path.exists(abs_path):
+        with open(abs_path, "wb") as f:
+            f.write(data)
+    return rel_path
+
+def _migrate_inline_images(notes):
+    # 旧形式（base64のデータURI）の画像をファイルに書き出してパスに置き換える
+    migrated = False
+    for note in notes:
+        for entry in note.get("entries", []):
+            entry_type = entry.get("type")
+            if entry_type not in ("image", "drawing", "combined"):
+                continue
+            field = "image" if entry_type == "combined" else "data"
+            value = entry.get(field)
+            if isinstance(value, str) and value.startswith("data:image"):
+                image = Image.open(io.BytesIO(base64.b64decode(value.split(",", 1)[1])))
+                entry[field] = save_image(image)
+                migrated = True
+    return migrated
+
+# --- 書き込みスレッド ---
+# ファイルへの書き込みは1本のスレッドが投入順に処理し、画面の応答をディスクI/Oから切り離す。
+# キャッシュがクリアされてストアが作り直されても、古いキューに残った書き込みと順序が入れ替わらないよう、
+# スレッドはキャッシュの外でプロセスに1本だけ起動し、キューは使い回す
+
+def _background_writer():
+    for thread in threading.enumerate():
+        if thread.name == WRITER_THREAD_NAME:
+            return thread.jobs
+    jobs = queue.Queue()
+
+    def run():
+        while True:
+            func, args = jobs.get()
+            try:
+                func(*args)
+            except Exception:
+                logging.exception("ファイルへの書き込みに失敗しました")
+            finally:
+                jobs.task_done()
+
+    thread = threading.Thread(target=run, name=WRITER_THREAD_NAME, daemon=True)
+    thread.jobs = jobs
+    thread.start()
+    atexit.register(jobs.join)
+    return jobs
+
+def _write_later(store, func, *args):
+    store["jobs"].put((func, args))
+
+# --- ノートの保存 (JSON Lines) ---
+# ノートは notes.jsonl に1行1件で追記し、削除は {"op": "del", "id": ...} の墓標を追記する。
+# 既存ノートへの書き込みは entries/<世代>/<note_id>.jsonl に追記し、読み込み時にまとめて畳み込む。
+# 全件の書き直しは save_notes によるコンパクション時のみ行い、そのたびに世代を1つ進める。
+# notes.jsonl の先頭行 {"op": "gen", "gen": n} と一致する世代の書き込みだけを読むため、
+# 置き換えの直後に落ちて古い世代のファイルが残っても二重には取り込まれない。
+def _entries_dir(gen):
+    # 世代0（世代の記録がない notes.jsonl）の書き込みは entries/ 直下に置く
+    return os.path.join(ENTRIES_DIR, str(gen)) if gen else ENTRIES_DIR
+
+def _entries_path(gen, note_id):
+    return os.path.join(_entries_dir(gen), f"{note_id}.jsonl")
+
+def _read_jsonl(file_path):
+    with open(file_path, "rb") as f:
+        return [orjson.loads(line) for line in f if line.strip()]
+
+def _dump_line(record):
+    return orjson.dumps(record, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE)
+
+def _append_bytes(file_path, data):
+    with open(file_path, "ab") as f:
+        f.write(data)
+
+def _append_jsonl(store, file_path, record):
+    # 後からノートが変更されても影響しないよう、バイト列への変換だけはこの場で行う
+    _write_later(store, _append_bytes, file_path, _dump_line(record))
+
+def _read_notes():
+    # ノートと、コンパクションで消せる行・ファイルの数と、現在の世代を返す
+    notes_by_id = {}
+    garbage = 0
+    gen = 0
+    if os.path.exists(NOTES_FILE):
+        for record in _read_jsonl(NOTES_FILE):
+            if record.get("op") == "gen":
+                gen = record["gen"]
+            elif record.get("op") == "del":
+                garbage += 1 + (notes_by_id.pop(record["id"], None) is not None)
+            else:
+                notes_by_id[record["id"]] = record
+    if os.path.isdir(_entries_dir(gen)):
+        for entry_file in os.scandir(_entries_dir(gen)):
+            if not entry_file.is_file():
+                continue
+            garbage += 1
+            note = notes_by_id.get(entry_file.name[:-len(".jsonl")])
+            if note is not None:
+                note.setdefault("entries", []).extend(_read_jsonl(entry_file.path))
+    return notes_by_id, garbage, gen
+
+def _remove_stale_entries(gen):
+    # 現在の世代以外の書き込みファイル・ディレクトリを消す
+    for entry_file in os.scandir(ENTRIES_DIR):
+        if entry_file.is_dir():
+            if entry_file.name != str(gen):
+                shutil.rmtree(entry_file.path)
+        elif gen:
+            os.remove(entry_file.path)
+
+def _serialize_notes(notes):
+    return b"".join(_dump_line(note) for note in notes)
+
+def _rewrite_notes_file(data, gen):
+    # 一時ファイルに書いてから置き換えることで、書き込み途中で落ちてもファイルが壊れないようにする。
+    # 一時ファイル名にはプロセスIDを含めて複数プロセスの衝突を避け、fsync はせずカーネルの書き戻しに任せる
+    os.makedirs(_entries_dir(gen), exist_ok=True)
+    tmp_path = f"{NOTES_FILE}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb", buffering=1 << 20) as f:
+        f.write(_dump_line({"op": "gen", "gen": gen}))
+        f.write(data)
+    os.replace(tmp_path, NOTES_FILE)
+    _remove_stale_entries(gen)
+
+def save_notes(notes, gen):
+    _rewrite_notes_file(_serialize_notes(notes), gen)
+
+# --- ノートのストア ---
+# ノートの正本はプロセス全体で共有するメモリ上の {id: note} で、ファイルは永続化のためのログとしてのみ使う。
+# 変更はすべて lock を取ってから行い、version を進めることで派生キャッシュ（座標・タグ索引など）を無効化する。
+@st.cache_resource(show_spinner=False)
+def notes_store():
+    # 作り直しのときは、前のストアが投入した書き込みをすべてファイルに反映してから読み込む
+    jobs = _background_writer()
+    jobs.join()
+    if not os.path.exists(NOTES_FILE) and os.path.exists(LEGACY_NOTES_FILE):
+        save_notes(load_data(LEGACY_NOTES_FILE), 1)
+    notes_by_id, garbage, gen = _read_notes()
+    if _migrate_inline_images(notes_by_id.values()):
+        gen += 1
+        save_notes(notes_by_id.values(), gen)
+        garbage = 0
+    else:
+        _remove_stale_entries(gen)
+    return {"lock": threading.RLock(), "notes": notes_by_id, "version": 0, "garbage": garbage, "gen": gen, "jobs": jobs}
+
+def notes_version():
+    return notes_store()["version"]
+
+def load_notes():
+    store = notes_store()
+    with store["lock"]:
+        return list(store["notes"].values())
+
+def load_notes_by_id():
+    # id で引くための {id: note} のスナップショット。リストから辞書を組み直す手間を省く
+    store = notes_store()
+    with store["lock"]:
+        return dict(store["notes"])
+
+def _schedule_compaction(store):
+    # 現時点の内容をここで文字列化して投入する。書き込みスレッドはそれより前の追記を書き終えてから置き換えるため、ログと食い違わない。
+    # 以降の書き込みは新しい世代のディレクトリに追記する
+    store["gen"] += 1
+    _write_later(store, _rewrite_notes_file, _serialize_notes(store["notes"].values()), store["gen"])
+    store["garbage"] = 0
+
+def _record_change(store, garbage=0):
+    store["version"] += 1
+    store["garbage"] += garbage
+    if store["garbage"] > COMPACT_THRESHOLD:
+        _schedule_compaction(store)
+
+def append_note(note):
+    store = notes_store()
+    with store["lock"]:
+        store["notes"][note['id']] = note
+        _append_jsonl(store, NOTES_FILE, note)
+        _record_change(store)
+
+def append_entry(note_id, entry):
+    store = notes_store()
+    with store["lock"]:
+        note = store["notes"].get(note_id)
+        if note is None:
+            return
+        note.setdefault("entries", []).append(entry)
+        _append_jsonl(store, _entries_path(store["gen"], note_id), entry)
+        _record_change(store, garbage=1)
+
+def delete_note(note_id):
+    store = notes_store()
+    with store["lock"]:
+        if store["notes"].pop(note_id, None) is None:
+            return
+        _append_jsonl(store, NOTES_FILE, {"op": "del", "id": note_id})
+        _record_change(store, garbage=2)
+
+def replace_all_notes(notes):
+    store = notes_store()
+    with store["lock"]:
+        store["notes"] = {note['id']: note for note in notes}
+        _record_change(store)
+        _schedule_compaction(store)
+
+@st.cache_data(show_spinner=False, max_entries=2)
+def _note_columns(version):
+    notes = load_notes()
+    ids = np.array([note['id'] for note in notes], dtype=object)
+    lats = np.array([note['lat'] for note in notes], dtype=np.float64)
+    lngs = np.array([note['lng'] for note in notes], dtype=np.float64)
+    return ids, lats, lngs
+
+def load_note_columns():
+    return _note_columns(notes_version())
+
+@st.cache_data(show_spinner=False, max_entries=2)
+def note_option_labels(version):
+    return {note['id']: f"📖 {note['title']} ({note['creator_name']})" for note in load_notes()}
+
+@st.cache_resource(show_spinner=False, max_entries=2)
+def build_tag_index(version):
+    # ハッシュタグ -> そのタグを含むノートIDの集合（ノート本体と書き込みの両方のタグを対象）。
+    # 検索のたびに索引を複製しないよう cache_resource で共有するため、呼び出し側で変更しないこと
+    index = {}
+    for note in load_notes():
+        tags = set(note.get("hashtags", []))
+        for entry in note.get("entries", []):
+            tags.update(entry.get("hashtags", []))
+        for tag in tags:
+            index.setdefault(tag, set()).add(note['id'])
+    return index
+
+def haversine_km(lats, lngs, user_lat, user_lng):
+    dlat = np.radians(lats - user_lat)
+    dlng = np.radians(lngs - user_lng)
+    a = np.sin(dlat / 2) ** 2 + np.cos(np.radians(user_lat)) * np.cos(np.radians(lats)) * np.sin(dlng / 2) ** 2
+    return 2 * 6371.0 * np.arcsin(np.sqrt(a))
+
+def nearby_mask(lats, lngs, user_lat, user_lng, km=10.0):
+    return haversine_km(lats, lngs, user_lat, user_lng) <= km
+
+def note_distance_km(note, location):
+    return float(haversine_km(np.array([note['lat']]), np.array([note['lng']]), location['latitude'], location['longitude'])[0])
+
+def is_note_nearby(note):
+    # 現在の位置・ノートで計算済みの近隣ノート集合があればそれを引き、なければその場で距離を計算する
+    if (st.session_state.get('_nearby_loc_ts') == st.session_state.get('_loc_ts')
+            and st.session_state.get('_nearby_version') == notes_version()):
+        return note['id'] in st.session_state.get('_nearby_ids', set())
+    return note_distance_km(note, st.session_state.user_location) <= 10
+
+def _bcrypt_input(password):
+    # bcrypt は72バイトまでしか扱えない（bcrypt 5 では超えると例外になる）ため、SHA-256 を base64 にした44バイトを渡す
+    return base64.b64encode(hashlib.sha256(password.encode()).digest())
+
+def hash_password(password):
+    return bcrypt.hashpw(_bcrypt_input(password), bcrypt.gensalt(rounds=12)).decode()
+
+def is_legacy_password_hash(password_hash):
+    # 旧形式（ソルトなしSHA-256の16進文字列）かどうか
+    return _LEGACY_HASH_RE.fullmatch(password_hash) is not None
+
+def verify_password(password, password_hash):
+    if is_legacy_password_hash(password_hash):
+        return hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), password_hash)
+    return bcrypt.checkpw(_bcrypt_input(password), password_hash.encode())
 
 def parse_hashtags(tag_string):
     if not tag_string:
         return []
-    tags = {f"#{tag.lstrip('#')}" for tag in tag_string.split() if tag}
+    tags = {f"#{tag}" for tag in _HASHTAG_RE.findall(tag_string)}
     return sorted(list(tags))
 
 # --- Google Maps API関連の関数 ---
+@st.cache_resource(show_spinner=False)
+def _create_gmaps_client(api_key):
+    return googlemaps.Client(key=api_key)
+
 def get_gmaps_client():
     try:
         api_key = st.secrets["Maps_api_key"]
-        return googlemaps.Client(key=api_key)
+        return _create_gmaps_client(api_key)
     except Exception:
         st.error("Google Maps APIキーがst.secretsに設定されていません。")
         return None
 
 # --- OpenAI API関連の関数 ---
+@st.cache_resource(show_spinner=False)
+def _create_openai_client(api_key):
+    return openai.OpenAI(api_key=api_key)
+
 def get_openai_client():
     try:
-        client = openai.OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
+        client = _create_openai_client(st.secrets["OPENAI_API_KEY"])
         return client
     except Exception:
         st.error("OpenAI APIキーがst.secretsに設定されていません。")
         return None
 
+# --- 地図 ---
+def build_note_map(center, zoom, notes, recommended_id, selected_id, user_location):
+    m = folium.Map(
+        location=center,
+        zoom_start=zoom,
+        prefer_canvas=True
+    )
+
+    LocateControl(auto_start=False, position='topright').add_to(m)
+
+    if user_location:
+        folium.CircleMarker(
+            location=[user_location['latitude'], user_location['longitude']],
+            radius=10, color='blue', fill=True, fill_color='blue', fill_opacity=0.6, popup='あなたの現在地'
+        ).add_to(m)
+
+    # 通常のノートはクライアント側でクラスタリングし、おすすめ・選択中のノートだけ個別のマーカーで重ねる
+    highlighted_ids = {recommended_id, selected_id}
+    cluster_data = []
+    for note in notes:
+        popup_text = f"📖 {html.escape(note['title'])}<br>設置者: {html.escape(note['creator_name'])}"
+        if note['id'] not in highlighted_ids:
+            cluster_data.append([note['lat'], note['lng'], popup_text])
+            continue
+
+        is_recommended = (note['id'] == recommended_id)
+        icon_color = 'purple' if is_recommended else 'beige'
+        if is_recommended:
+            popup_text = "👑 AIのおすすめ！<br>" + popup_text
+
+        folium.Marker(
+            location=[note['lat'], note['lng']],
+            popup=popup_text,
+            icon=folium.Icon(color=icon_color, icon='book', prefix='fa')
+        ).add_to(m)
+
+    if cluster_data:
+        FastMarkerCluster(cluster_data, callback=NOTE_MARKER_CALLBACK).add_to(m)
+    return m
+
+def note_summary(note):
+    first_entry = "書き込みなし"
+    if note.get("entries"):
+        entry = note["entries"][0]
+        first_entry = entry.get("text") if entry.get("type") == "combined" else entry.get("data", "")
+        if entry.get("type") in ("image", "drawing"):
+            first_entry = "画像の書き込み"
+    return {
+        "id": note["id"],
+        "title": note["title"],
+        "hashtags": note.get("hashtags", []),
+        "first_entry": first_entry
+    }
+
+def _embed_texts(client, texts, batch_size=1000):
+    vectors = []
+    for start in range(0, len(texts), batch_size):
+        response = client.embeddings.create(model=EMBEDDING_MODEL, input=texts[start:start + batch_size])
+        vectors.extend(item.embedding for item in response.data)
+    matrix = np.array(vectors, dtype=np.float32)
+    return matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+
+# (ノートID, 要約文) -> 正規化済みベクトル。ノートが書き換わっても、要約文が変わったノートだけを埋め込み直す。
+# 辞書は書き換えずに丸ごと差し替えるため、取り出した後はロックなしで読める。
+# 組み立てた行列は直近の1つだけ持ち、呼び出し側では読み取りのみ行う
+@st.cache_resource(show_spinner=False)
+def _embedding_cache():
+    return {"lock": threading.Lock(), "vectors": {}, "matrix": None}
+
+def _note_embeddings(client, notes):
+    summaries = [note_summary(note) for note in notes]
+    keys = [(s["id"], f"{s['title']} {' '.join(s['hashtags'])} {s['first_entry']}") for s in summaries]
+    cache = _embedding_cache()
+    with cache["lock"]:
+        if cache["matrix"] is not None and cache["matrix"][0] == keys:
+            return cache["matrix"][1:]
+        known = cache["vectors"]
+    missing = [key for key in keys if key not in known]
+    fresh = dict(zip(missing, _embed_texts(client, [text for _, text in missing]))) if missing else {}
+    # 今のノートにないキー（削除・変更前のノート）はここで捨てる
+    vectors = {key: known[key] if key in known else fresh[key] for key in keys}
+    ids = np.array([note_id for note_id, _ in keys], dtype=object)
+    matrix = np.stack(list(vectors.values()))
+    with cache["lock"]:
+        cache["vectors"] = vectors
+        cache["matrix"] = (keys, ids, matrix)
+    return ids, matrix
+
+def select_candidate_notes(client, notes, prompt, k=RECOMMEND_CANDIDATES):
+    # プロンプトとの類似度が高い上位k件だけをAIに渡す。埋め込みが使えない場合は全件を渡す
+    if len(notes) <= k:
+        return notes
+    try:
+        ids, matrix = _note_embeddings(client, notes)
+        scores = matrix @ _embed_texts(client, [prompt])[0]
+    except Exception:
+        return notes
+    top = np.argpartition(-scores, k)[:k]
+    top = top[np.argsort(-scores[top])]
+    notes_by_id = {note['id']: note for note in notes}
+    return [notes_by_id[note_id] for note_id in ids[top] if note_id in notes_by_id]
+
+def stream_reply_text(stream, raw_chunks):
+    # 受信中のJSONから "reply" の文字列だけを逐次デコードして返す。受信した全文は raw_chunks に溜める
+    buffer = ""
+    pos = None
+    done = False
+    for chunk in stream:
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if not delta:
+            continue
+        raw_chunks.append(delta)
+        if done:
+            continue
+        buffer += delta
+        if pos is None:
+            match = _REPLY_START_RE.search(buffer)
+            if not match:
+                continue
+            pos = match.end()
+        end = pos
+        while end < len(buffer):
+            if buffer[end] == "\\":
+                escape_len = 6 if buffer[end + 1:end + 2] == "u" else 2
+                # サロゲートペアの上位側は単独ではUTF-8にできないため、続く下位側のエスケープが届いてから一緒にデコードする
+                if _HIGH_SURROGATE_RE.match(buffer, end):
+                    escape_len = 12
+                if end + escape_len > len(buffer):
+                    break
+                end += escape_len
+            elif buffer[end] == '"':
+                done = True
+                break
+            else:
+                end += 1
+        if end > pos:
+            yield json.loads('"' + buffer[pos:end] + '"')
+            pos = end
+
+def search_grid_centers(lat, lng, radius, grid_size=3):
+    # 半径radiusの検索範囲を grid_size×grid_size のセルに分割し、各セルの中心座標とセル半径を返す
+    cell = 2 * radius / grid_size
+    dlat = cell / 111_000
+    dlng = dlat / math.cos(math.radians(lat))
+    offsets = [i - (grid_size - 1) / 2 for i in range(grid_size)]
+    centers = [(lat + i * dlat, lng + j * dlng) for i in offsets for j in offsets]
+    return centers, cell / 2 * math.sqrt(2)
+
+@st.cache_data(ttl=86400, show_spinner=False)
+def geocode_cached(_gmaps, query, language='ja'):
+    return _gmaps.geocode(query, language=language)
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def search_nearby_places(_gmaps, lat, lng, place_types):
+    # 初期ノートの生成はストアが空のときにしか行わないため、キャッシュが効くのは同じ地点で生成をやり直す場合に限られる
+    centers, cell_radius = search_grid_centers(lat, lng, 1500)
+
+    # 1回の検索は最大20件までなので、範囲をグリッドに分けて種類×セルごとに並列で検索する。
+    # 結果の統合は投入順に1スレッドで行うため、重複排除にロックは不要。
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        futures = [(executor.submit(_gmaps.places_nearby, location=center, radius=cell_radius, language='ja', type=place_type), place_type)
+                   for place_type in place_types for center in centers]
+    responses = []
+    failed = 0
+    for future, place_type in futures:
+        try:
+            responses.append((place_type, future.result()))
+        except Exception as e:
+            failed += 1
+            last_error = e
+    if failed == len(futures):
+        raise last_error
+    return responses, failed, len(futures)
+
 def generate_initial_notes(gmaps, lat, lng):
     st.info("現在地情報を基に、周辺の初期ノートを生成しています...少々お待ちください。")
     try:
-        search_location = (lat, lng)
-        place_types = ['cafe', 'park', 'tourist_attraction', 'restaurant', 'art_gallery']
+        place_types = ('cafe', 'park', 'tourist_attraction', 'restaurant', 'art_gallery')
         initial_notes = []
         processed_place_ids = set()
 
-        for place_type in place_types:
-            response = gmaps.places_nearby(location=search_location, radius=1500, language='ja', type=place_type)
+        # 約110m単位に丸めた座標をキャッシュのキーにする
+        search_args = (gmaps, round(lat, 3), round(lng, 3), place_types)
+        responses, failed, total = search_nearby_places(*search_args)
+        if failed:
+            # 一時的な失敗で欠けた結果が1時間残らないよう、この呼び出しのキャッシュは捨てる
+            search_nearby_places.clear(*search_args)
+            st.warning(f"{total}件中{failed}件の周辺検索に失敗しました。")
+
+        for place_type, response in responses:
             for place in response.get('results', []):
                 place_id = place.get('place_id')
                 if place_id and place_id not in processed_place_ids:
@@ -96,7 +650,7 @@ def generate_initial_notes(gmaps, lat, lng):
                     processed_place_ids.add(place_id)
 
         if initial_notes:
-            save_data(NOTES_FILE, initial_notes)
+            replace_all_notes(initial_notes)
             st.success(f"あなたの現在地周辺に {len(initial_notes)}件の初期ノートを生成しました。")
             time.sleep(3)
         else:
@@ -119,10 +673,221 @@ for key, default in {
     if key not in st.session_state:
         st.session_state[key] = default
 
+# --- ボタンのコールバック ---
+# on_clickで状態を変えておけば、ボタン押下による再実行だけで画面に反映されるため st.rerun() は不要
+def cancel_note_placement():
+    st.session_state.clicked_location = None
+
+def clear_search_results():
+    st.session_state.search_results = None
+
+def start_chat():
+    st.session_state.chat_started = True
+    st.session_state.chat_messages = [
+        {"role": "assistant", "content": "こんにちは！どんな場所の思い出に浸りたい気分ですか？例えば、「静かな場所」「美味しいものが食べられる場所」など、あなたの気分や興味を教えてください。"}
+    ]
+    st.session_state.recommended_note_id = None
+
+def stop_chat():
+    st.session_state.chat_started = False
+    st.session_state.chat_messages = []
+
+def show_more_entries():
+    st.session_state._entry_limit += ENTRY_PAGE_SIZE
+
+def post_entry(note):
+    # 書き込みを保存してからフラグメントが再実行されるため、一覧には再実行なしで新しい書き込みが表示される
+    text_input = st.session_state.entry_text
+    uploaded_file = st.session_state.entry_image
+    if not st.session_state.user_location or not st.session_state.user_location.get('latitude'):
+        st.session_state._entry_post_message = ("error", "現在地が取得できていないため投稿できません。ブラウザで位置情報の使用を許可してください。")
+    elif not is_note_nearby(note):
+        distance = note_distance_km(note, st.session_state.user_location)
+        st.session_state._entry_post_message = ("error", f"このノートには、10km以内に近づかないと書き込みできません。(現在約 {distance:.2f} km)")
+    elif not text_input and not uploaded_file:
+        st.session_state._entry_post_message = ("warning", "メッセージを入力するか、画像をアップロードしてください。")
+    else:
+        post_time = datetime.now().timestamp()
+        author_name = st.session_state.current_user['name']
+        hashtags = parse_hashtags(st.session_state.entry_hashtags)
+
+        # 画像はアップロードされたバイト列から1度だけデコードして保存する
+        image_path = None
+        if uploaded_file:
+            img = Image.open(io.BytesIO(uploaded_file.getvalue()))
+            img.load()
+            image_path = save_image(img)
+
+        if text_input and uploaded_file:
+            new_entry = {"author_name": author_name, "timestamp": post_time, "type": "combined", "text": text_input, "image": image_path, "hashtags": hashtags}
+        elif text_input:
+            new_entry = {"author_name": author_name, "timestamp": post_time, "type": "text", "data": text_input, "hashtags": hashtags}
+        else:
+            new_entry = {"author_name": author_name, "timestamp": post_time, "type": "image", "data": image_path, "hashtags": hashtags}
+        append_entry(note['id'], new_entry)
+        st.session_state._entry_post_message = ("success", "投稿しました！")
+
+def delete_selected_note(title):
+    delete_note(st.session_state.selected_note_id)
+    st.session_state.update({"selected_note_id": None, "nearby_notes": [], "search_results": None, "recommended_note_id": None,
+                             "_deleted_note_title": title})
+
+def logout():
+    st.session_state.clear()
+
+# --- 地図と近隣ノート ---
+def _refresh_live_state(version):
+    notes_by_id = load_notes_by_id()
+    all_notes = list(notes_by_id.values())
+    notes_to_display = st.session_state.search_results if st.session_state.search_results is not None else all_notes
+
+    # 近隣ノートは位置情報かノートが前回の計算から変わったときだけ計算し直す
+    if st.session_state.user_location and not st.session_state.search_results and (
+            st.session_state.get('_nearby_loc_ts') != st.session_state.get('_loc_ts') or st.session_state.get('_nearby_version') != version):
+        note_ids, note_lats, note_lngs = load_note_columns()
+        mask = nearby_mask(note_lats, note_lngs, st.session_state.user_location['latitude'], st.session_state.user_location['longitude'])
+        st.session_state.nearby_notes = [notes_by_id[note_id] for note_id in note_ids[mask] if note_id in notes_by_id]
+        st.session_state._nearby_ids = set(note_ids[mask].tolist())
+        st.session_state._nearby_loc_ts = st.session_state.get('_loc_ts')
+        st.session_state._nearby_version = version
+
+    # 地図は表示内容が変わったときだけ作り直す。中心とズームはst_foliumに渡して動かすため、キーには含めない
+    user_location = st.session_state.user_location
+    map_key = (
+        version, tuple(note['id'] for note in notes_to_display),
+        st.session_state.get('recommended_note_id'), st.session_state.selected_note_id,
+        (round(user_location['latitude'], 4), round(user_location['longitude'], 4)) if user_location else None
+    )
+    cached_map = st.session_state.get('_map_cache')
+    if cached_map and cached_map[0] == map_key:
+        return cached_map[1]
+    m = build_note_map(st.session_state.center, st.session_state.zoom, notes_to_display,
+                       st.session_state.get('recommended_note_id'), st.session_state.selected_note_id, user_location)
+    st.session_state._map_cache = (map_key, m)
+    return m
+
+# 自動更新ONのときはこのフラグメントだけが定期的に再実行され、他のユーザーが追加したノートを反映する
+@st.fragment(run_every=AUTO_REFRESH_INTERVAL_S if st.session_state.auto_refresh else None)
+def live_panel():
+    # ノートの版と表示条件が前回と同じなら（何も起きていない定期実行）、ノートの読み直しと地図の組み立てを省いて前回の地図をそのまま渡す
+    version = notes_version()
+    seen = (version, st.session_state.search_results, st.session_state.get('recommended_note_id'),
+            st.session_state.selected_note_id, st.session_state.get('_loc_ts'))
+    if st.session_state.get('_live_seen') == seen and '_map_cache' in st.session_state:
+        m = st.session_state._map_cache[1]
+    else:
+        m = _refresh_live_state(version)
+        st.session_state._live_seen = seen
+
+    map_data = st_folium(m, width="100%", height=550, center=st.session_state.center, zoom=st.session_state.zoom,
+                         returned_objects=["last_clicked", "center", "zoom"], key="main_map")
+
+    if map_data and map_data.get("last_clicked") and st.session_state.mode == "ノート設置モード":
+        if st.session_state.get('clicked_location') != map_data["last_clicked"]:
+            st.session_state.clicked_location = map_data["last_clicked"]
+            st.rerun()
+
+    if map_data and "center" in map_data and map_data["center"] is not None:
+        if st.session_state.center != [map_data["center"]["lat"], map_data["center"]["lng"]]:
+            st.session_state.center = [map_data["center"]["lat"], map_data["center"]["lng"]]
+        if st.session_state.zoom != map_data["zoom"]:
+            st.session_state.zoom = map_data["zoom"]
+
+# --- ノート詳細 ---
+# 書き込み・削除はこのペインの中だけで完結するため、フラグメントとして再実行し地図やサイドバーの再描画を避ける
+@st.fragment
+def render_selected_note():
+    # 削除ボタンではこのフラグメントだけが再実行されるが、地図やサイドバーの選択・検索結果も変わるため画面全体を再実行する。
+    # 削除の通知は画面全体の実行の側で出す
+    if '_deleted_note_title' in st.session_state:
+        st.rerun()
+
+    # フラグメント単独で再実行されるときのために、ノートはここでストアから取り直す
+    notes_by_id = load_notes_by_id()
+    current_user_info = st.session_state.current_user
+    is_viewable = False
+    selected_note = None
+
+    if st.session_state.main_menu == "📖 ノート操作" and st.session_state.mode == "ノート書き込みモード" and st.session_state.selected_note_id:
+        selected_note = notes_by_id.get(st.session_state.selected_note_id)
+        if selected_note:
+            is_recommended = selected_note['id'] == st.session_state.recommended_note_id
+
+            is_close_enough = False
+            if st.session_state.user_location:
+                is_close_enough = is_note_nearby(selected_note)
+
+            if is_recommended or is_close_enough:
+                is_viewable = True
+            elif not st.session_state.user_location:
+                st.error("現在地が取得できていないため、ノートの内容を表示できません。")
+            else:
+                st.warning(f"このノートを閲覧・書き込みするには10km以内に近づく必要があります。")
+
+    if is_viewable and selected_note:
+        header_text = "👑 AIのおすすめ<br>" if selected_note['id'] == st.session_state.recommended_note_id else ""
+        header_text += f"📖 {selected_note['title']}"
+        st.markdown(header_text, unsafe_allow_html=True)
+
+        if selected_note.get("hashtags"):
+            st.caption(" ".join(selected_note["hashtags"]))
+
+        # 書き込みは新しいものから ENTRY_PAGE_SIZE 件ずつ表示する（ノートを切り替えたら件数を戻す）
+        entries = selected_note.get("entries", [])
+        if st.session_state.get('_entry_limit_note') != selected_note['id']:
+            st.session_state._entry_limit_note = selected_note['id']
+            st.session_state._entry_limit = ENTRY_PAGE_SIZE
+        visible_entries = entries[-st.session_state._entry_limit:]
+
+        with st.container(height=300):
+            st.write("**これまでの書き込み**")
+            if not entries:
+                st.info("まだ書き込みはありません。")
+            elif len(visible_entries) < len(entries):
+                st.button(f"もっと見る（残り{len(entries) - len(visible_entries)}件）", on_click=show_more_entries)
+
+            for entry in visible_entries:
+                st.markdown(f"**{entry['author_name']}** (`{datetime.fromtimestamp(entry['timestamp']).strftime('%Y-%m-%d %H:%M')}`)")
+                if entry.get("hashtags"):
+                    st.caption(" ".join(entry["hashtags"]))
+                entry_type = entry.get('type')
+                if entry_type == 'text':
+                    st.info(entry['data'])
+                elif entry_type in ['image', 'drawing']:
+                    st.image(os.path.join(DATA_DIR, entry['data']), use_container_width=True)
+                elif entry_type == 'combined':
+                    st.info(entry['text'])
+                    st.image(os.path.join(DATA_DIR, entry['image']), use_container_width=True)
+                st.markdown("---")
+
+        st.subheader("新しいページを追加")
+        with st.form("entry_form", clear_on_submit=True):
+            st.text_area("メッセージ (任意)", key="entry_text")
+            st.file_uploader("画像を添付 (任意)", type=['png', 'jpg', 'jpeg'], key="entry_image")
+            st.text_input("ハッシュタグ (スペース区切り)", placeholder="例: 楽しかった また来たい", key="entry_hashtags")
+            st.form_submit_button("投稿する", on_click=post_entry, args=(selected_note,))
+        # 投稿の結果はコールバックの中では表示できないため、ここで表示する
+        post_message = st.session_state.pop('_entry_post_message', None)
+        if post_message:
+            getattr(st, post_message[0])(post_message[1])
+
+        if selected_note['creator_id'] == current_user_info['id']:
+            st.markdown("---")
+            with st.expander("🗑️ ノートを削除"):
+                st.warning("この操作は取り消せません。")
+                if st.checkbox("本当に削除しますか？"):
+                    st.button("このノートを削除する", type="primary", on_click=delete_selected_note, args=(selected_note['title'],))
+
+    elif st.session_state.main_menu == "📖 ノート操作" and st.session_state.mode == "ノート書き込みモード" and not st.session_state.selected_note_id:
+        st.info("サイドバーで書き込みたいノートを選択するか、AIにおすすめを聞いてみましょう。")
+
+    elif st.session_state.main_menu != "📖 ノート操作":
+        st.info("サイドバーで操作を選択してください。")
+
 # --- 認証ページ ---
 if not st.session_state.current_user:
     st.header("思い出ノートへようこそ 📖")
-    users_data = load_data(USERS_FILE, is_dict=True)
+    init_users_db()
 
     login_tab, register_tab = st.tabs(["ログイン", "新規登録"])
     with login_tab:
@@ -131,8 +896,11 @@ if not st.session_state.current_user:
             login_password = st.text_input("パスワード", type="password")
             submitted = st.form_submit_button("ログイン")
             if submitted:
-                user = users_data.get(login_id)
-                if user and user["password_hash"] == hash_password(login_password):
+                user = get_user(login_id)
+                if user and verify_password(login_password, user["password_hash"]):
+                    if is_legacy_password_hash(user["password_hash"]):
+                        user["password_hash"] = hash_password(login_password)
+                        update_password_hash(user["id"], user["password_hash"])
                     st.session_state.current_user = user
                     st.session_state.initial_load = True
                     st.rerun()
@@ -147,19 +915,18 @@ if not st.session_state.current_user:
             if submitted:
                 if not (register_id and register_name and register_password):
                     st.warning("すべての項目を入力してください。")
-                elif register_id in users_data:
-                    st.error("そのユーザーIDは既に使用されています。")
                 else:
                     new_user = {
                         "id": register_id, "name": register_name,
                         "password_hash": hash_password(register_password)
                     }
-                    users_data[register_id] = new_user
-                    save_data(USERS_FILE, users_data)
-                    st.session_state.current_user = new_user
-                    st.session_state.initial_load = True
-                    st.success(f"{register_name} さん、登録が完了しました！")
-                    st.rerun()
+                    if not create_user(new_user):
+                        st.error("そのユーザーIDは既に使用されています。")
+                    else:
+                        st.session_state.current_user = new_user
+                        st.session_state.initial_load = True
+                        st.success(f"{register_name} さん、登録が完了しました！")
+                        st.rerun()
 
 # --- メインアプリケーション ---
 else:
@@ -173,13 +940,25 @@ else:
 
     gmaps = get_gmaps_client()
     openai_client = get_openai_client()
-    all_notes = load_data(NOTES_FILE)
+    notes_by_id = load_notes_by_id()
+    all_notes = list(notes_by_id.values())
     current_user_info = st.session_state.current_user
     st.set_page_config(layout="wide")
 
+    # ノート詳細のフラグメントで削除されたノートの通知（コールバックやフラグメントの中では出さない）
+    deleted_note_title = st.session_state.pop('_deleted_note_title', None)
+    if deleted_note_title:
+        st.toast(f"ノート「{deleted_note_title}」を削除しました。")
+
+    # 位置情報は一定距離以上動いたか、前回の更新から時間が経った場合のみ反映する
     location = streamlit_geolocation()
     if location and location.get('latitude'):
-        st.session_state.user_location = location
+        prev = st.session_state.user_location
+        moved = prev is None or haversine_km(prev['latitude'], prev['longitude'], location['latitude'], location['longitude']) * 1000 > LOCATION_MIN_MOVE_M
+        stale = time.time() - st.session_state.get('_loc_ts', 0) > LOCATION_MAX_AGE_S
+        if moved or stale:
+            st.session_state.user_location = location
+            st.session_state._loc_ts = time.time()
 
     if gmaps and not all_notes and st.session_state.user_location and not st.session_state.initial_notes_generated:
         generate_initial_notes(gmaps, st.session_state.user_location['latitude'], st.session_state.user_location['longitude'])
@@ -195,15 +974,11 @@ else:
         st.session_state.center = [st.session_state.user_location['latitude'], st.session_state.user_location['longitude']]
         st.session_state.zoom = 15
         st.session_state.initial_load = False
-        st.rerun()
 
     if st.session_state.center is None:
         st.info("📍 現在位置を取得しています...（ブラウザの許可が必要です）")
     else:
-        if st.session_state.user_location and not st.session_state.search_results:
-            user_coords = (st.session_state.user_location['latitude'], st.session_state.user_location['longitude'])
-            st.session_state.nearby_notes = [note for note in all_notes if great_circle(user_coords, (note['lat'], note['lng'])).km <= 10]
-
+        version = notes_version()
         with st.sidebar:
             st.header(f"ようこそ、{current_user_info['name']}さん")
             selected_menu = st.radio("メインメニュー", ("📖 ノート操作", "🔍 検索", "⚙️ アカウント"), horizontal=True, label_visibility="collapsed", key="main_menu")
@@ -236,17 +1011,14 @@ else:
                                             "creator_id": current_user_info['id'], "creator_name": current_user_info['name'],
                                             "entries": []
                                         }
-                                        all_notes.append(new_note)
-                                        save_data(NOTES_FILE, all_notes)
+                                        append_note(new_note)
                                         st.success(f"ノート「{note_title}」を設置しました！")
                                         st.balloons()
                                         st.session_state.clicked_location = None
                                         st.rerun()
                                     else:
                                         st.warning("ノートのタイトルを入力してください。")
-                            if st.button("キャンセル"):
-                                st.session_state.clicked_location = None
-                                st.rerun()
+                            st.button("キャンセル", on_click=cancel_note_placement)
 
                     elif mode == "ノート書き込みモード":
                         st.subheader("✍️ ノートに書き込む")
@@ -255,18 +1027,17 @@ else:
                         if not notes_for_selection:
                             st.info("表示できるノートがありません。")
                         else:
-                            note_ids = [note['id'] for note in notes_for_selection]
-                            index = None
-                            if st.session_state.selected_note_id and st.session_state.selected_note_id in note_ids:
-                                index = note_ids.index(st.session_state.selected_note_id)
+                            note_positions = {note['id']: i for i, note in enumerate(notes_for_selection)}
+                            note_ids = list(note_positions)
+                            index = note_positions.get(st.session_state.selected_note_id)
 
-                            note_options = {note['id']: f"📖 {note['title']} ({note['creator_name']})" for note in notes_for_selection}
-                            selected_id = st.selectbox("書き込むノートを選択", options=list(note_options.keys()), format_func=lambda x: note_options[x], index=index, placeholder="ノートを選んでください")
+                            note_labels = note_option_labels(version)
+                            selected_id = st.selectbox("書き込むノートを選択", options=note_ids, format_func=lambda x: note_labels.get(x, x), index=index, placeholder="ノートを選んでください")
 
                             if selected_id and selected_id != st.session_state.selected_note_id:
                                 st.session_state.selected_note_id = selected_id
                                 st.session_state.recommended_note_id = None
-                                selected_note_obj = next((n for n in all_notes if n['id'] == selected_id), None)
+                                selected_note_obj = notes_by_id.get(selected_id)
                                 if selected_note_obj:
                                     st.session_state.center = [selected_note_obj['lat'], selected_note_obj['lng']]
                                     st.session_state.zoom = 17
@@ -277,7 +1048,7 @@ else:
                     search_query = st.text_input("地名や住所で検索...", key="main_search")
                     if st.button("検索", key="main_search_btn"):
                         if gmaps and search_query:
-                            geocode_result = gmaps.geocode(search_query, language='ja')
+                            geocode_result = geocode_cached(gmaps, search_query)
                             if geocode_result:
                                 loc = geocode_result[0]['geometry']['location']
                                 st.session_state.center = [loc['lat'], loc['lng']]
@@ -293,16 +1064,13 @@ else:
                     search_mode = st.radio("検索モード", ["AND (すべて含む)", "OR (いずれかを含む)"], key="search_mode")
                     if st.button("検索する", key="search_hashtag_btn"):
                         if hashtag_query_input:
-                            queries = [f"#{q.lstrip('#')}" for q in hashtag_query_input.split()]
-                            found_notes = []
-                            for note in all_notes:
-                                all_tags_in_note = set(note.get("hashtags", []))
-                                for entry in note.get("entries", []):
-                                    all_tags_in_note.update(entry.get("hashtags", []))
-                                if "AND" in search_mode:
-                                    if all(q in all_tags_in_note for q in queries): found_notes.append(note)
-                                else:
-                                    if any(q in all_tags_in_note for q in queries): found_notes.append(note)
+                            queries = parse_hashtags(hashtag_query_input)
+                            tag_index = build_tag_index(notes_version())
+                            tag_sets = [tag_index.get(q, set()) for q in queries]
+                            matching_ids = set()
+                            if tag_sets:
+                                matching_ids = set.intersection(*tag_sets) if "AND" in search_mode else set.union(*tag_sets)
+                            found_notes = [note for note in all_notes if note['id'] in matching_ids] if matching_ids else []
                             st.session_state.search_results = found_notes
                             st.success(f"「{' '.join(queries)}」で{len(found_notes)}件のノートが見つかりました。")
                             st.rerun()
@@ -310,9 +1078,7 @@ else:
                             st.warning("検索するハッシュタグを入力してください。")
 
                     if st.session_state.search_results is not None:
-                        if st.button("検索をクリア"):
-                            st.session_state.search_results = None
-                            st.rerun()
+                        st.button("検索をクリア", on_click=clear_search_results)
 
                     st.markdown("---")
                     st.subheader("🤖 AIにおすすめを聞く")
@@ -320,13 +1086,7 @@ else:
                     if not all_notes:
                         st.warning("まだノートがありません。AIに相談する前にノートを作成してください。")
                     elif openai_client:
-                        if st.button("AIと相談を始める", key="start_chat_btn"):
-                            st.session_state.chat_started = True
-                            st.session_state.chat_messages = [
-                                {"role": "assistant", "content": "こんにちは！どんな場所の思い出に浸りたい気分ですか？例えば、「静かな場所」「美味しいものが食べられる場所」など、あなたの気分や興味を教えてください。"}
-                            ]
-                            st.session_state.recommended_note_id = None
-                            st.rerun()
+                        st.button("AIと相談を始める", key="start_chat_btn", on_click=start_chat)
 
                         if st.session_state.chat_started:
                             for msg in st.session_state.chat_messages:
@@ -337,253 +1097,83 @@ else:
                                 st.chat_message("user").write(prompt)
 
                                 with st.spinner("AIが考えています..."):
-                                    notes_summary_list = []
-                                    for note in all_notes:
-                                        summary = {
-                                            "id": note["id"],
-                                            "title": note["title"],
-                                            "hashtags": note.get("hashtags", []),
-                                            "first_entry": note["entries"][0]["data"] if note.get("entries") else "書き込みなし"
-                                        }
-                                        notes_summary_list.append(summary)
+                                    candidate_notes = select_candidate_notes(openai_client, all_notes, prompt)
+                                    notes_summary_list = [note_summary(note) for note in candidate_notes]
                                     notes_json_str = json.dumps(notes_summary_list, ensure_ascii=False)
 
-                                    system_prompt = f"""
-                                    あなたは、ユーザーとの対話を通じて、最適な「思い出ノート」を提案するAIアシスタントです。
-                                    提供されたノートリストの中から、ユーザーの気分や要望に最も合うものを1つだけ選んでください。
-                                    会話の最後には、必ず提案するノートのIDを `{{ "recommended_note_id": "(ここにID)" }}` というJSON形式のみで回答してください。
-                                    JSONの前後に他のテキストは含めないでください。
+                                system_prompt = f"""
+                                あなたは、ユーザーとの対話を通じて、最適な「思い出ノート」を提案するAIアシスタントです。
+                                提供されたノートリストの中から、ユーザーの気分や要望に最も合うものを1つだけ選んでください。
+                                ユーザーへの返答は reply に入れてください。
+                                提案するノートが決まったら、そのIDを recommended_note_id に入れてください。まだ決まっていない場合は空文字にしてください。
+
+                                利用可能なノートリスト:
+                                {notes_json_str}
+                                """
+
+                                messages_for_api = [
+                                    {"role": "system", "content": system_prompt}
+                                ] + st.session_state.chat_messages
+
+                                try:
+                                    stream = openai_client.chat.completions.create(
+                                        model=RECOMMEND_MODEL,
+                                        messages=messages_for_api,
+                                        temperature=0.7,
+                                        response_format=RECOMMEND_RESPONSE_FORMAT,
+                                        stream=True,
+                                    )
+                                    raw_chunks = []
+                                    st.chat_message("assistant").write_stream(stream_reply_text(stream, raw_chunks))
+                                    msg = "".join(raw_chunks)
+
+                                    try:
+                                        reco_data = json.loads(msg)
+                                    except json.JSONDecodeError:
+                                        st.session_state.chat_messages.append({"role": "assistant", "content": msg})
+                                        st.rerun()
 
-                                    利用可能なノートリスト:
-                                    {notes_json_str}
-                                    """
+                                    conversation_text = reco_data.get("reply", "").strip()
+                                    reco_id = reco_data.get("recommended_note_id")
+                                    if conversation_text:
+                                        st.session_state.chat_messages.append({"role": "assistant", "content": conversation_text})
 
-                                    messages_for_api = [
-                                        {"role": "system", "content": system_prompt}
-                                    ] + st.session_state.chat_messages
+                                    if reco_id:
+                                        time.sleep(2)
 
-                                    try:
-                                        response = openai_client.chat.completions.create(
-                                            model="gpt-4-turbo",
-                                            messages=messages_for_api,
-                                            temperature=0.7,
-                                        )
-                                        msg = response.choices[0].message.content
-                                        json_match = re.search(r'\{\s*"recommended_note_id":\s*".*?"\s*\}', msg, re.DOTALL)
-
-                                        if json_match:
-                                            json_str = json_match.group(0)
-                                            conversation_text = msg.replace(json_str, "").strip()
-
-                                            try:
-                                                reco_data = json.loads(json_str)
-                                                reco_id = reco_data.get("recommended_note_id")
-
-                                                if reco_id:
-                                                    if conversation_text:
-                                                        st.session_state.chat_messages.append({"role": "assistant", "content": conversation_text})
-                                                        st.chat_message("assistant").write(conversation_text)
-                                                        time.sleep(2)
-
-                                                    # --- 👇 修正箇所 2: AI提案後の処理 ---
-                                                    # session_stateを直接変更せず、一時フラグを立ててrerunする
-                                                    st.session_state.recommended_note_id = reco_id
-                                                    st.session_state.selected_note_id = reco_id
-                                                    st.session_state.chat_started = False
-                                                    st.session_state._switch_to_note_mode = True # 👈 一時フラグを設定
-
-                                                    recommended_note = next((n for n in all_notes if n['id'] == reco_id), None)
-                                                    if recommended_note:
-                                                        st.success(f"AIがあなたに「{recommended_note['title']}」をおすすめしました！")
-                                                        st.session_state.center = [recommended_note['lat'], recommended_note['lng']]
-                                                        st.session_state.zoom = 17
-
-                                                    st.rerun() # 👈 アプリケーションを再実行
-                                                    # --- 👆 修正完了 ---
-
-                                            except json.JSONDecodeError:
-                                                st.session_state.chat_messages.append({"role": "assistant", "content": msg})
-                                                st.rerun()
-                                        else:
-                                            st.session_state.chat_messages.append({"role": "assistant", "content": msg})
-                                            st.rerun()
-
-                                    except Exception as e:
-                                        st.error(f"AIとの通信中にエラーが発生しました: {e}")
-
-                        if st.session_state.chat_started and st.button("相談をやめる"):
-                            st.session_state.chat_started = False
-                            st.session_state.chat_messages = []
-                            st.rerun()
+                                        # --- 👇 修正箇所 2: AI提案後の処理 ---
+                                        # session_stateを直接変更せず、一時フラグを立ててrerunする
+                                        st.session_state.recommended_note_id = reco_id
+                                        st.session_state.selected_note_id = reco_id
+                                        st.session_state.chat_started = False
+                                        st.session_state._switch_to_note_mode = True # 👈 一時フラグを設定
+
+                                        recommended_note = notes_by_id.get(reco_id)
+                                        if recommended_note:
+                                            st.success(f"AIがあなたに「{recommended_note['title']}」をおすすめしました！")
+                                            st.session_state.center = [recommended_note['lat'], recommended_note['lng']]
+                                            st.session_state.zoom = 17
+                                        # --- 👆 修正完了 ---
+
+                                    st.rerun() # 👈 アプリケーションを再実行
+
+                                except Exception as e:
+                                    st.error(f"AIとの通信中にエラーが発生しました: {e}")
+
+                        if st.session_state.chat_started:
+                            st.button("相談をやめる", on_click=stop_chat)
 
                 elif selected_menu == "⚙️ アカウント":
                     st.subheader("アプリ設定")
                     st.toggle("🗺️ マップの自動更新", key="auto_refresh", help="ONにすると5秒ごとに現在地と近くのノートを自動で更新します。")
                     st.markdown("---")
                     st.subheader("アカウント操作")
-                    if st.button("ログアウト"):
-                        for key in st.session_state.keys():
-                            del st.session_state[key]
-                        st.rerun()
+                    st.button("ログアウト", on_click=logout)
 
         col1, col2 = st.columns([2, 1])
 
         with col1:
-            m = folium.Map(
-                location=st.session_state.center,
-                zoom_start=st.session_state.zoom
-            )
-
-            LocateControl(auto_start=False, position='topright').add_to(m)
-
-            if st.session_state.user_location:
-                folium.CircleMarker(
-                    location=[st.session_state.user_location['latitude'], st.session_state.user_location['longitude']],
-                    radius=10, color='blue', fill=True, fill_color='blue', fill_opacity=0.6, popup='あなたの現在地'
-                ).add_to(m)
-
-            for note in notes_to_display:
-                is_recommended = (note['id'] == st.session_state.get('recommended_note_id'))
-                icon_color = 'purple' if is_recommended else 'beige'
-                popup_text = f"👑 AIのおすすめ！\n" if is_recommended else ""
-                popup_text += f"📖 {note['title']}\n設置者: {note['creator_name']}"
-
-                folium.Marker(
-                    location=[note['lat'], note['lng']],
-                    popup=popup_text,
-                    icon=folium.Icon(color=icon_color, icon='book', prefix='fa')
-                ).add_to(m)
-
-            map_data = st_folium(m, width="100%", height=550, center=st.session_state.center, zoom=st.session_state.zoom)
-
-            if map_data and map_data.get("last_clicked") and st.session_state.mode == "ノート設置モード":
-                if st.session_state.get('clicked_location') != map_data["last_clicked"]:
-                    st.session_state.clicked_location = map_data["last_clicked"]
-                    st.rerun()
-
-            if map_data and "center" in map_data and map_data["center"] is not None:
-                if st.session_state.center != [map_data["center"]["lat"], map_data["center"]["lng"]]:
-                    st.session_state.center = [map_data["center"]["lat"], map_data["center"]["lng"]]
-                if st.session_state.zoom != map_data["zoom"]:
-                    st.session_state.zoom = map_data["zoom"]
+            live_panel()
 
         with col2:
-            is_viewable = False
-            selected_note = None
-
-            if st.session_state.main_menu == "📖 ノート操作" and st.session_state.mode == "ノート書き込みモード" and st.session_state.selected_note_id:
-                selected_note = next((n for n in all_notes if n['id'] == st.session_state.selected_note_id), None)
-                if selected_note:
-                    is_recommended = selected_note['id'] == st.session_state.recommended_note_id
-
-                    is_close_enough = False
-                    if st.session_state.user_location:
-                        user_coords = (st.session_state.user_location['latitude'], st.session_state.user_location['longitude'])
-                        note_coords = (selected_note['lat'], selected_note['lng'])
-                        if great_circle(user_coords, note_coords).km <= 10:
-                                is_close_enough = True
-
-                    if is_recommended or is_close_enough:
-                        is_viewable = True
-                    elif not st.session_state.user_location:
-                        st.error("現在地が取得できていないため、ノートの内容を表示できません。")
-                    else:
-                        st.warning(f"このノートを閲覧・書き込みするには10km以内に近づく必要があります。")
-
-            if is_viewable and selected_note:
-                header_text = "👑 AIのおすすめ<br>" if selected_note['id'] == st.session_state.recommended_note_id else ""
-                header_text += f"📖 {selected_note['title']}"
-                st.markdown(header_text, unsafe_allow_html=True)
-
-                if selected_note.get("hashtags"):
-                    st.caption(" ".join(selected_note["hashtags"]))
-
-                with st.container(height=300):
-                    st.write("**これまでの書き込み**")
-                    if not selected_note.get("entries", []):
-                        st.info("まだ書き込みはありません。")
-
-                    for entry in selected_note.get("entries", []):
-                        st.markdown(f"**{entry['author_name']}** (`{datetime.fromtimestamp(entry['timestamp']).strftime('%Y-%m-%d %H:%M')}`)")
-                        if entry.get("hashtags"):
-                            st.caption(" ".join(entry["hashtags"]))
-                        entry_type = entry.get('type')
-                        if entry_type == 'text':
-                            st.info(entry['data'])
-                        elif entry_type in ['image', 'drawing']:
-                            st.image(entry['data'], use_container_width=True)
-                        elif entry_type == 'combined':
-                            st.info(entry['text'])
-                            st.image(entry['image'], use_container_width=True)
-                        st.markdown("---")
-
-                st.subheader("新しいページを追加")
-                with st.form("entry_form", clear_on_submit=True):
-                    text_input = st.text_area("メッセージ (任意)")
-                    uploaded_file = st.file_uploader("画像を添付 (任意)", type=['png', 'jpg', 'jpeg'])
-                    entry_hashtags = st.text_input("ハッシュタグ (スペース区切り)", placeholder="例: 楽しかった また来たい")
-                    submitted = st.form_submit_button("投稿する")
-
-                    if submitted:
-                        post_allowed = False
-                        if st.session_state.user_location and st.session_state.user_location.get('latitude'):
-                            user_coords = (st.session_state.user_location['latitude'], st.session_state.user_location['longitude'])
-                            note_coords = (selected_note['lat'], selected_note['lng'])
-                            distance = great_circle(user_coords, note_coords).km
-                            if distance <= 10:
-                                post_allowed = True
-                            else:
-                                st.error(f"このノートには、10km以内に近づかないと書き込みできません。(現在約 {distance:.2f} km)")
-                        else:
-                            st.error("現在地が取得できていないため投稿できません。ブラウザで位置情報の使用を許可してください。")
-
-                        if post_allowed:
-                            if not text_input and not uploaded_file:
-                                st.warning("メッセージを入力するか、画像をアップロードしてください。")
-                            else:
-                                new_entry = None
-                                post_time = datetime.now().timestamp()
-                                author_name = current_user_info['name']
-                                hashtags = parse_hashtags(entry_hashtags)
-
-                                if text_input and uploaded_file:
-                                    img = Image.open(uploaded_file)
-                                    b64_str = image_to_base64(img, format=img.format or "JPEG")
-                                    new_entry = {"author_name": author_name, "timestamp": post_time, "type": "combined", "text": text_input, "image": b64_str, "hashtags": hashtags}
-                                elif text_input:
-                                    new_entry = {"author_name": author_name, "timestamp": post_time, "type": "text", "data": text_input, "hashtags": hashtags}
-                                elif uploaded_file:
-                                    img = Image.open(uploaded_file)
-                                    b64_str = image_to_base64(img, format=img.format or "JPEG")
-                                    new_entry = {"author_name": author_name, "timestamp": post_time, "type": "image", "data": b64_str, "hashtags": hashtags}
-
-                                if new_entry:
-                                    selected_note.setdefault("entries", []).append(new_entry)
-                                    save_data(NOTES_FILE, all_notes)
-                                    st.success("投稿しました！")
-                                    st.rerun()
-
-                if selected_note['creator_id'] == current_user_info['id']:
-                    st.markdown("---")
-                    with st.expander("🗑️ ノートを削除"):
-                        st.warning("この操作は取り消せません。")
-                        if st.checkbox("本当に削除しますか？"):
-                            if st.button("このノートを削除する", type="primary"):
-                                all_notes = [n for n in all_notes if n['id'] != st.session_state.selected_note_id]
-                                save_data(NOTES_FILE, all_notes)
-                                st.success(f"ノート「{selected_note['title']}」を削除しました。")
-                                st.session_state.selected_note_id = None
-                                st.session_state.nearby_notes = []
-                                st.session_state.search_results = None
-                                st.session_state.recommended_note_id = None
-                                st.rerun()
-
-            elif st.session_state.main_menu == "📖 ノート操作" and st.session_state.mode == "ノート書き込みモード" and not st.session_state.selected_note_id:
-                st.info("サイドバーで書き込みたいノートを選択するか、AIにおすすめを聞いてみましょう。")
-
-            elif st.session_state.main_menu != "📖 ノート操作":
-                st.info("サイドバーで操作を選択してください。")
-
-        if st.session_state.auto_refresh:
-            time.sleep(5)
-            st.rerun()
+            render_selected_note()